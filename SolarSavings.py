@@ -1,8 +1,36 @@
 from homeassistant.components.recorder import get_instance
-from homeassistant.components.recorder.history import get_significant_states
+from homeassistant.components.recorder.history import get_significant_states, state_changes_during_period
 from homeassistant.components.recorder.statistics import statistics_during_period
 from datetime import datetime, timezone, timedelta
 
+# Read entities
+BUY_PRICE_ENTITY_ID = 'sensor.electricity_buy_price'
+SELL_PRICE_ENTITY_ID = 'sensor.electricity_sell_price'
+TESLA_WALLCONNECTOR_ENERGY_ENTITY_ID = 'sensor.tesla_wall_connector_energy'
+PURCHASED_KWH_TOTAL_ENTITY_ID = 'sensor.power_meter_consumption'
+EXPORTED_KWH_TOTAL_ENTITY_ID = 'sensor.power_meter_exported'
+INVERTER_YIELD_KWH_TOTAL_ENTITY_ID = 'sensor.inverter_total_yield'
+NIBE_ENERGY_USED_LAST_HOUR_ENTITY_ID = 'sensor.nibe_energy_used_last_hour'
+
+# Write entities
+# These have to be created as helpers in HA
+SOLAR_SAVINGS_ENTITY_ID = 'input_number.solar_savings'
+CAR_CHARGE_COST_WITHOUT_SOLAR_ENTITY_ID = 'input_number.car_charge_without_solar'
+CAR_CHARGE_COST_WITH_SOLAR_ENTITY_ID = 'input_number.car_charge_with_solar'
+HEAT_PUMP_COST_WITHOUT_SOLAR_ENTITY_ID = 'input_number.heat_pump_cost_without_solar'
+HEAT_PUMP_COST_WITH_SOLAR_ENTITY_ID = 'input_number.heat_pump_cost_with_solar'
+HEAT_PUMP_CONSUMED_KWH_ENTITY_ID = 'input_number.heat_pump_consumed_kwh'
+
+_MONETARY_ATTRS = {
+    'state_class': 'total',
+    'device_class': 'monetary',
+    'unit_of_measurement': '€',
+}
+
+# Counters whose monetary attributes are known to be set, so the attribute
+# check only runs once per counter instead of every hour
+_attrs_initialized = set()
+
 
 async def _get_statistic(
     start_time: datetime,
@@ -18,29 +46,79 @@ async def _get_statistic(
     return(await get_instance(hass).async_add_executor_job(statistics_during_period, hass, start_time, end_time, statistic_ids, period, None, types))
 
 
-async def _get_history(
+@pyscript_compile
+def _fetch_boundary_states(hass, start_time, end_time, entity_ids):
+    # Only the first and last states in the window are needed for the deltas,
+    # so issue two index seeks per entity instead of scanning every change
+    boundaries = {}
+    for entity_id in entity_ids:
+        first_rows = state_changes_during_period(hass, start_time, end_time, entity_id, no_attributes=True, limit=1).get(entity_id)
+        last_rows = state_changes_during_period(hass, start_time, end_time, entity_id, no_attributes=True, descending=True, limit=1, include_start_time_state=False).get(entity_id)
+        if not first_rows:
+            # Fall back to the significant states scan for the window
+            first_rows = get_significant_states(hass, start_time, end_time, [entity_id], None, True, False, False, True, False).get(entity_id)
+        if first_rows:
+            boundaries[entity_id] = (first_rows[0], (last_rows or first_rows)[-1])
+    return boundaries
+
+
+async def _get_boundary_states(
         start_time: dt,
         end_time: dt,
-        entity_ids: list[str],
-        include_start_time_state: bool,
-        significant_changes_only: bool,
-        minimal_response: bool,
-        no_attributes: bool):
+        entity_ids: list[str]):
+
+    # Callers pass UTC aware datetimes, so no conversion is needed here
+
+    return (await get_instance(hass).async_add_executor_job(_fetch_boundary_states, hass, start_time, end_time, entity_ids))
+
+
+def _boundary_delta(boundaries, entity_id):
+    first, last = boundaries[entity_id]
+    return float(last.state) - float(first.state)
+
+
+async def _get_energy_deltas(start_time, end_time, entity_ids):
+    # The recorder already aggregates the energy meters as long term
+    # statistics, so read the precomputed change per entity and only fall
+    # back to boundary states for entities without statistics
+    stats = await _get_statistic(start_time, end_time, entity_ids, "hour", ['change'])
+    deltas = {}
+    missing = []
+    for entity_id in entity_ids:
+        rows = stats.get(entity_id)
+        if rows:
+            deltas[entity_id] = sum(float(d['change']) for d in rows if d.get('change') is not None)
+        else:
+            missing.append(entity_id)
+    if missing:
+        boundaries = await _get_boundary_states(start_time, end_time, missing)
+        for entity_id in missing:
+            deltas[entity_id] = _boundary_delta(boundaries, entity_id)
+    return deltas
+
+
+def _last_hour_window():
+    """Return the start and end of the previous full hour as UTC datetimes"""
+    hour_start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    return hour_start - timedelta(hours=1), hour_start
 
-    start_time = start_time.astimezone(timezone.utc)
-    end_time = end_time.astimezone(timezone.utc)
 
-    return (await get_instance(hass).async_add_executor_job(get_significant_states, hass, start_time, end_time, entity_ids, None, include_start_time_state, significant_changes_only, minimal_response, no_attributes, False))
+def _read_counter(sensor_id):
+    """Read the current numeric value of an accumulator counter"""
+    return float(state.get(sensor_id))
 
 
 def _sum_value_to_sensor(value, sensor_id):
-    current_value = float(state.get(sensor_id))
-    attributes = state.getattr(sensor_id)
-    if attributes is None or 'device_class' not in attributes.keys():
-        state.setattr(sensor_id+'.state_class', 'total')
-        state.setattr(sensor_id+'.device_class', 'monetary')
-        state.setattr(sensor_id+'.unit_of_measurement', '€')
-    state.set(sensor_id, current_value+value)
+    new_value = _read_counter(sensor_id) + value
+    if sensor_id not in _attrs_initialized:
+        attributes = state.getattr(sensor_id)
+        if attributes is None or 'device_class' not in attributes:
+            # Write the value and the missing attributes as one merged state update
+            state.set(sensor_id, new_value, **_MONETARY_ATTRS)
+            _attrs_initialized.add(sensor_id)
+            return
+        _attrs_initialized.add(sensor_id)
+    state.set(sensor_id, new_value)
 
 
 def _calculate_overall_solar_savings_last_hour(last_hour_exported_kwh, last_hour_produced_kwh, last_hour_buy_price, last_hour_sell_price):
@@ -63,59 +141,60 @@ def _calculate_heat_pump_cost_with_solar_last_hour(last_hour_buy_price, last_hou
     return (last_hour_buy_price * last_hour_purchased_kwh * heat_pump_share_of_purchase)/100.0
 
 
+# Cost rules: each pairs a counter entity with the function computing its
+# hourly increment from the shared metrics
+_COST_RULES = [
+    (SOLAR_SAVINGS_ENTITY_ID,
+     lambda m: _calculate_overall_solar_savings_last_hour(m['exported_kwh'], m['produced_kwh'], m['buy_price'], m['sell_price'])),
+    (CAR_CHARGE_COST_WITHOUT_SOLAR_ENTITY_ID,
+     lambda m: _calculate_car_charge_cost_without_solar_last_hour(m['buy_price'], m['charged_kwh'])),
+    (CAR_CHARGE_COST_WITH_SOLAR_ENTITY_ID,
+     lambda m: _calculate_car_charge_cost_with_solar_last_hour(m['buy_price'], m['purchased_kwh'], m['car_share_of_purchase'])),
+    (HEAT_PUMP_COST_WITHOUT_SOLAR_ENTITY_ID,
+     lambda m: _calculate_heat_pump_cost_without_solar_last_hour(m['buy_price'], m['heat_pump_used_kwh'])),
+    (HEAT_PUMP_COST_WITH_SOLAR_ENTITY_ID,
+     lambda m: _calculate_heat_pump_cost_with_solar_last_hour(m['buy_price'], m['purchased_kwh'], m['heat_pump_share_of_purchase'])),
+    (HEAT_PUMP_CONSUMED_KWH_ENTITY_ID,
+     lambda m: m['heat_pump_used_kwh']),
+]
+
+
 @time_trigger("cron(2 * * * *)")
-def calculateSolarSavingsLastHour():
+async def calculateSolarSavingsLastHour():
     """Calculate the savings from solar panels during the previous hour"""
-    # Read entities
-    buy_price_entity_id = 'sensor.electricity_buy_price'
-    sell_price_entity_id = 'sensor.electricity_sell_price'
-    tesla_wallconnector_energy_entity_id = 'sensor.tesla_wall_connector_energy'
-    purchased_kwh_total_entity_id = 'sensor.power_meter_consumption'
-    exported_kwh_total_entity_id = 'sensor.power_meter_exported'
-    inverter_yield_kwh_total_entity_id = 'sensor.inverter_total_yield'
-    nibe_energy_used_last_hour_kwh_total_entity_id = 'sensor.nibe_energy_used_last_hour'
-
-    # Write entities
-    # These have to be created as helpers in HA
-    solar_savings_entity_id = 'input_number.solar_savings'
-    car_charge_cost_without_solar_entity_id = 'input_number.car_charge_without_solar'
-    car_charge_cost_with_solar_entity_id = 'input_number.car_charge_with_solar'
-    heat_pump_cost_without_solar_entity_id = 'input_number.heat_pump_cost_without_solar'
-    heat_pump_cost_with_solar_entity_id = 'input_number.heat_pump_cost_with_solar'
-    heat_pump_consumed_kwh_entity_id = 'input_number.heat_pump_consumed_kwh'
-
     # Start and end of last hour
-    last_hour_start = datetime.now() - timedelta(hours=1)
-    last_hour_start = last_hour_start.replace(minute=0, second=0, microsecond=0)
-    last_hour_end = datetime.now()
-    last_hour_end = last_hour_end.replace(minute=0, second=0, microsecond=0)
+    last_hour_start, last_hour_end = _last_hour_window()
 
-    # Spot prices
-    last_hour_prices = _get_statistic(last_hour_start, last_hour_end, [buy_price_entity_id, sell_price_entity_id], "hour", ['state'])
-    last_hour_buy_price = float(last_hour_prices[buy_price_entity_id][0]['state'])
-    last_hour_sell_price = float(last_hour_prices[sell_price_entity_id][0]['state'])
+    # The price statistics and energy deltas are independent, so run the
+    # delta fetch in a parallel task while the prices are fetched (pyscript
+    # eagerly awaits interpreted function calls in argument position, so
+    # asyncio.gather cannot be used to overlap them)
+    deltas_task = task.create(_get_energy_deltas, last_hour_start, last_hour_end, [EXPORTED_KWH_TOTAL_ENTITY_ID, INVERTER_YIELD_KWH_TOTAL_ENTITY_ID, TESLA_WALLCONNECTOR_ENERGY_ENTITY_ID, PURCHASED_KWH_TOTAL_ENTITY_ID])
+
+    last_hour_prices = await _get_statistic(last_hour_start, last_hour_end, [BUY_PRICE_ENTITY_ID, SELL_PRICE_ENTITY_ID], "hour", ['state'])
 
-    # Fetch all data from history
-    last_hour_history = _get_history(last_hour_start, last_hour_end, [exported_kwh_total_entity_id, inverter_yield_kwh_total_entity_id, tesla_wallconnector_energy_entity_id, purchased_kwh_total_entity_id], True, False, False, True)
+    task.wait({deltas_task})
+    last_hour_deltas = deltas_task.result()
+
+    # Spot prices
+    last_hour_buy_price = float(last_hour_prices[BUY_PRICE_ENTITY_ID][0]['state'])
+    last_hour_sell_price = float(last_hour_prices[SELL_PRICE_ENTITY_ID][0]['state'])
 
     # Calculate energy usages last hour
-    last_hour_exported_kwh = float(last_hour_history[exported_kwh_total_entity_id][-1].state) - float(last_hour_history[exported_kwh_total_entity_id][0].state)
-    last_hour_produced_kwh = float(last_hour_history[inverter_yield_kwh_total_entity_id][-1].state) - float(last_hour_history[inverter_yield_kwh_total_entity_id][0].state)
-    last_hour_purchased_kwh = float(last_hour_history[purchased_kwh_total_entity_id][-1].state) - float(last_hour_history[purchased_kwh_total_entity_id][0].state)
-    last_hour_charged_kwh = (float(last_hour_history[tesla_wallconnector_energy_entity_id][-1].state) - float(last_hour_history[tesla_wallconnector_energy_entity_id][0].state))/1000.0
-    last_hour_heat_pump_used_kwh = float(state.get(nibe_energy_used_last_hour_kwh_total_entity_id))
+    last_hour_exported_kwh = last_hour_deltas[EXPORTED_KWH_TOTAL_ENTITY_ID]
+    last_hour_produced_kwh = last_hour_deltas[INVERTER_YIELD_KWH_TOTAL_ENTITY_ID]
+    last_hour_purchased_kwh = last_hour_deltas[PURCHASED_KWH_TOTAL_ENTITY_ID]
+    last_hour_charged_kwh = last_hour_deltas[TESLA_WALLCONNECTOR_ENERGY_ENTITY_ID]/1000.0
+    last_hour_heat_pump_used_kwh = float(state.get(NIBE_ENERGY_USED_LAST_HOUR_ENTITY_ID))
     last_hour_consumed_solar = last_hour_produced_kwh - last_hour_exported_kwh
 
-    # Correct for kWh purchased exchange for kWh exported during the hour
-    if last_hour_exported_kwh > 0.001 and last_hour_purchased_kwh > 0.001:
-        if last_hour_purchased_kwh >= last_hour_exported_kwh:
-            last_hour_purchased_kwh = last_hour_purchased_kwh - last_hour_exported_kwh
-            last_hour_consumed_solar = last_hour_consumed_solar + last_hour_exported_kwh
-            last_hour_exported_kwh = 0.0
-        else:
-            last_hour_exported_kwh = last_hour_exported_kwh - last_hour_purchased_kwh
-            last_hour_consumed_solar = last_hour_consumed_solar + last_hour_purchased_kwh
-            last_hour_purchased_kwh = 0.0
+    # Correct for kWh purchased exchange for kWh exported during the hour;
+    # the overlap cancels out of both and counts as consumed solar instead
+    last_hour_exchanged_kwh = min(last_hour_purchased_kwh, last_hour_exported_kwh)
+    if last_hour_exchanged_kwh > 0.001:
+        last_hour_purchased_kwh = last_hour_purchased_kwh - last_hour_exchanged_kwh
+        last_hour_exported_kwh = last_hour_exported_kwh - last_hour_exchanged_kwh
+        last_hour_consumed_solar = last_hour_consumed_solar + last_hour_exchanged_kwh
 
     car_share_of_purchase = 0.0
     heat_pump_share_of_purchase = 0.0
@@ -124,21 +203,18 @@ def calculateSolarSavingsLastHour():
         car_share_of_purchase = last_hour_charged_kwh / (last_hour_purchased_kwh + last_hour_produced_kwh)
         heat_pump_share_of_purchase = last_hour_heat_pump_used_kwh / (last_hour_purchased_kwh + last_hour_produced_kwh)
 
-    # Overall solar savings
-    overall_savings_last_hour = _calculate_overall_solar_savings_last_hour(last_hour_exported_kwh, last_hour_produced_kwh, last_hour_buy_price, last_hour_sell_price)
-    _sum_value_to_sensor(overall_savings_last_hour, solar_savings_entity_id)
-
-    # Car charge cost and savings
-    car_charge_cost_without_solar_last_hour = _calculate_car_charge_cost_without_solar_last_hour(last_hour_buy_price, last_hour_charged_kwh)
-    car_charge_cost_with_solar_last_hour = _calculate_car_charge_cost_with_solar_last_hour(last_hour_buy_price, last_hour_purchased_kwh, car_share_of_purchase)
-    _sum_value_to_sensor(car_charge_cost_without_solar_last_hour, car_charge_cost_without_solar_entity_id)
-    _sum_value_to_sensor(car_charge_cost_with_solar_last_hour, car_charge_cost_with_solar_entity_id)
-
-    # Heat pump cost and savings
-    heat_pump_cost_without_solar_last_hour = _calculate_heat_pump_cost_without_solar_last_hour(last_hour_buy_price, last_hour_heat_pump_used_kwh)
-    heat_pump_cost_with_solar_last_hour = _calculate_heat_pump_cost_with_solar_last_hour(last_hour_buy_price, last_hour_purchased_kwh, heat_pump_share_of_purchase)
-    _sum_value_to_sensor(heat_pump_cost_without_solar_last_hour, heat_pump_cost_without_solar_entity_id)
-    _sum_value_to_sensor(heat_pump_cost_with_solar_last_hour, heat_pump_cost_with_solar_entity_id)
-
-    # Heat pump all time consumption
-    _sum_value_to_sensor(last_hour_heat_pump_used_kwh, heat_pump_consumed_kwh_entity_id)
+    metrics = {
+        'buy_price': last_hour_buy_price,
+        'sell_price': last_hour_sell_price,
+        'exported_kwh': last_hour_exported_kwh,
+        'produced_kwh': last_hour_produced_kwh,
+        'purchased_kwh': last_hour_purchased_kwh,
+        'charged_kwh': last_hour_charged_kwh,
+        'heat_pump_used_kwh': last_hour_heat_pump_used_kwh,
+        'car_share_of_purchase': car_share_of_purchase,
+        'heat_pump_share_of_purchase': heat_pump_share_of_purchase,
+    }
+
+    # Accumulate every cost counter from the shared metrics
+    for target_entity_id, calculate in _COST_RULES:
+        _sum_value_to_sensor(calculate(metrics), target_entity_id)
@@ -1,6 +1,12 @@
 from homeassistant.components.recorder import get_instance
 from homeassistant.components.recorder.statistics import statistics_during_period
-from datetime import datetime, timedelta
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from statistics import fmean
+import numpy as np
+
+# Long term prices only change when the day rolls over, so cache them per date
+_long_term_price_cache = {'date': None, 'data': None}
 
 
 async def _get_statistic(
@@ -17,123 +23,140 @@ async def _get_statistic(
     return(await get_instance(hass).async_add_executor_job(statistics_during_period, hass, start_time, end_time, statistic_ids, period, None, types))
 
 
-def _get_long_term_prices():
+async def _get_long_term_prices():
 
-    start_date = datetime.now() - timedelta(days=10)
-    start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    today = date.today()
+    if _long_term_price_cache['date'] == today:
+        return _long_term_price_cache['data']
 
-    end_date = datetime.now()
-    end_date = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    now = datetime.now()
+    start_date = (now - timedelta(days=10)).replace(hour=0, minute=0, second=0, microsecond=0)
+    end_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
 
     sensor = 'sensor.nordpool_spotprice_no_transfer'
 
-    stats = _get_statistic(start_date, end_date, [sensor], "hour", ['state'])
+    stats = await _get_statistic(start_date, end_date, [sensor], "hour", ['state'])
     stat = [{'start': d.get('start'), 'value': float(d.get('state'))} for d in stats.get(sensor)]
 
+    _long_term_price_cache['date'] = today
+    _long_term_price_cache['data'] = stat
+
     return stat
 
+def _calculate_cost_for_price(price, thresholds):
+    """Classify a price into a cost bucket by its position among the sorted thresholds"""
+    return bisect_right(thresholds, price)
+
+
+def _price_values(price_dictionaries):
+    """Extract the price values from a list of price dictionaries as a float array"""
+    return np.fromiter((d['value'] for d in price_dictionaries if 'value' in d), dtype=np.float64)
+
+
+def _running_stats(values, prior=None):
+    """Fold a segment of price values into running (count, sum, min, max) stats"""
+    if values.size == 0:
+        return prior if prior is not None else (0, 0.0, float('inf'), float('-inf'))
+    stats = (int(values.size), float(values.sum()), float(values.min()), float(values.max()))
+    if prior is None:
+        return stats
+    return (prior[0] + stats[0], prior[1] + stats[1], min(prior[2], stats[2]), max(prior[3], stats[3]))
+
+
 @service
 def spotPriceSensorsTestService(action=None, id=None):
     """Service to execute code through HA"""
-    log.warning(f"Manually triggering test service")
+    log.warning("Manually triggering test service")
 
 
 @time_trigger("cron(1 * * * *)")
-def calculateSpotPriceAverages():
+async def calculateSpotPriceAverages():
     """Calculates monthly and yearly spot price averages"""
 
     buy_price_entity_id = 'sensor.electricity_buy_price'
 
-    monthly_start_date = datetime.now()
-    monthly_start_date = monthly_start_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    monthly_end_date = datetime.now()
-    monthly_end_date = monthly_end_date.replace(month=monthly_end_date.month+1, day=1, hour=0, minute=0, second=0, microsecond=0)
-
-    monthly_raw = _get_statistic(monthly_start_date, monthly_end_date, [buy_price_entity_id], "hour", ['state'])
-    monthly_floats = [{'start': d.get('start'), 'value': float(d.get('state'))} for d in monthly_raw.get(buy_price_entity_id)]
-    monthly_prices = [d['value'] for d in monthly_floats if 'value' in d]
-    monthly_avg = sum(monthly_prices) / len(monthly_prices)
+    now = datetime.now()
 
-    input_number.electricity_buy_price_monthly_average = monthly_avg
-
-    yearly_start_date = datetime.now()
-    yearly_start_date = yearly_start_date.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-    yearly_end_date = datetime.now()
-    yearly_end_date = yearly_end_date.replace(year=yearly_end_date.year+1, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    monthly_start_date = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    yearly_start_date = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    yearly_end_date = yearly_start_date.replace(year=yearly_start_date.year+1)
 
-    yearly_raw = _get_statistic(yearly_start_date, yearly_end_date, [buy_price_entity_id], "hour", ['state'])
+    yearly_raw = await _get_statistic(yearly_start_date, yearly_end_date, [buy_price_entity_id], "hour", ['state'])
     yearly_floats = [{'start': d.get('start'), 'value': float(d.get('state'))} for d in yearly_raw.get(buy_price_entity_id)]
     yearly_prices = [d['value'] for d in yearly_floats if 'value' in d]
-    yearly_avg = sum(yearly_prices) / len(yearly_prices)
+    yearly_avg = fmean(yearly_prices)
+
+    # The monthly window is fully contained in the yearly result, so slice it
+    # out instead of issuing a second recorder query
+    monthly_start_timestamp = monthly_start_date.timestamp()
+    monthly_prices = [d['value'] for d in yearly_floats if d['start'] >= monthly_start_timestamp]
+    monthly_avg = fmean(monthly_prices)
 
+    input_number.electricity_buy_price_monthly_average = monthly_avg
     input_number.electricity_buy_price_yearly_average = yearly_avg
 
 
 @time_trigger("cron(2 * * * *)")
-def updateSpotPriceSensors():
+async def updateSpotPriceSensors():
     """Update spot price sensors based on future spot prices"""
 
-    price_dictionaries = sensor.nordpool_spotprice_no_transfer.raw_today
+    # Fetch the Nordpool attributes once instead of one proxy lookup per attribute
+    nordpool_attributes = state.getattr('sensor.nordpool_spotprice_no_transfer') or {}
+
+    prices_today = _price_values(nordpool_attributes.get('raw_today', []))
+
+    if nordpool_attributes.get('tomorrow_valid'):
+        prices_tomorrow = _price_values(nordpool_attributes.get('raw_tomorrow', []))
+    else:
+        prices_tomorrow = np.empty(0, dtype=np.float64)
+
+    prices_long_term = _price_values(await _get_long_term_prices())
+
+    # The windows nest, so today's stats extend into short's by folding in
+    # just tomorrow's values and short's into long's with just the 10 day values
+    stats_today = _running_stats(prices_today)
+    stats_short = _running_stats(prices_tomorrow, stats_today)
+    stats_long = _running_stats(prices_long_term, stats_short)
 
-    prices = [d['value'] for d in price_dictionaries if 'value' in d]
-    price_average_today = sum(prices) / len(prices)
-    price_min_today = min(prices)
-    price_max_today = max(prices)
+    n_values, price_sum, price_min_today, price_max_today = stats_today
+    price_average_today = price_sum / n_values
     price_25_percent_today = (price_average_today + price_min_today) / 2
     price_75_percent_today = (price_average_today + price_max_today) / 2
 
-    if sensor.nordpool_spotprice_no_transfer.tomorrow_valid:
-        price_dictionaries += sensor.nordpool_spotprice_no_transfer.raw_tomorrow
-
-    prices = [d['value'] for d in price_dictionaries if 'value' in d]
-    price_average_short = sum(prices) / len(prices)
-    price_min_short = min(prices)
-    price_max_short = max(prices)
+    n_values, price_sum, price_min_short, price_max_short = stats_short
+    price_average_short = price_sum / n_values
     price_25_percent_short = (price_average_short + price_min_short) / 2
     price_75_percent_short = (price_average_short + price_max_short) / 2
 
-    price_dictionaries += _get_long_term_prices()
-    prices = [d['value'] for d in price_dictionaries if 'value' in d]
-    price_average_long = sum(prices) / len(prices)
-    price_min_long = min(prices)
-    price_max_long = max(prices)
+    n_values, price_sum, price_min_long, price_max_long = stats_long
+    price_average_long = price_sum / n_values
     price_25_percent_long = (price_average_long + price_min_long) / 2
     price_75_percent_long = (price_average_long + price_max_long) / 2
 
-    price_current = sensor.nordpool_spotprice_no_transfer.current_price
-
-    input_number.spot_price_cost.price_current = price_current
-    input_number.spot_price_cost.price_average_short = price_average_short
-    input_number.spot_price_cost.price_min_short = price_min_short
-    input_number.spot_price_cost.price_max_short = price_max_short
-    input_number.spot_price_cost.price_25_percent_short = price_25_percent_short
-    input_number.spot_price_cost.price_75_percent_short = price_75_percent_short
-
-    input_number.spot_price_cost.price_average_long = price_average_long
-    input_number.spot_price_cost.price_min_long = price_min_long
-    input_number.spot_price_cost.price_max_long = price_max_long
-    input_number.spot_price_cost.price_25_percent_long = price_25_percent_long
-    input_number.spot_price_cost.price_75_percent_long = price_75_percent_long
-
-    input_number.spot_price_cost.price_average_today = price_average_today
-    input_number.spot_price_cost.price_min_today = price_min_today
-    input_number.spot_price_cost.price_max_today = price_max_today
-    input_number.spot_price_cost.price_25_percent_today = price_25_percent_today
-    input_number.spot_price_cost.price_75_percent_today = price_75_percent_today
-
-    cost_value = 0
-    cost_value_addition = 0
-
-    if price_current < price_25_percent_short:
-        cost_value = 0
-    elif price_current < price_average_short:
-        cost_value = 1
-    else:
-        cost_value = 2
-
-    if price_current < price_average_long:
-        cost_value_addition = 0
-    else:
-        cost_value_addition = 1
-
-    input_number.spot_price_cost = cost_value + cost_value_addition
\ No newline at end of file
+    price_current = nordpool_attributes.get('current_price')
+
+    # Collect all attributes into one dict so HA gets a single state write
+    # instead of one per attribute
+    price_attributes = {
+        'price_current': price_current,
+        'price_average_short': price_average_short,
+        'price_min_short': price_min_short,
+        'price_max_short': price_max_short,
+        'price_25_percent_short': price_25_percent_short,
+        'price_75_percent_short': price_75_percent_short,
+        'price_average_long': price_average_long,
+        'price_min_long': price_min_long,
+        'price_max_long': price_max_long,
+        'price_25_percent_long': price_25_percent_long,
+        'price_75_percent_long': price_75_percent_long,
+        'price_average_today': price_average_today,
+        'price_min_today': price_min_today,
+        'price_max_today': price_max_today,
+        'price_25_percent_today': price_25_percent_today,
+        'price_75_percent_today': price_75_percent_today,
+    }
+
+    cost_value = _calculate_cost_for_price(price_current, (price_25_percent_short, price_average_short))
+    cost_value_addition = int(price_current >= price_average_long)
+
+    state.set('input_number.spot_price_cost', cost_value + cost_value_addition, **price_attributes)
\ No newline at end of file